@@ -2,15 +2,29 @@
 # webmap_generator.py (no ZIP, satellite only, no opacity slider)
 # ============================================================
 
-import geopandas as gpd
-import folium, tempfile, requests, gdown, re, json, base64
+import numpy as np
+import pyogrio
+import folium, tempfile, requests, gdown, re, json, base64, importlib.util, functools, html, gzip
+from concurrent.futures import ThreadPoolExecutor
+from folium.plugins import MarkerCluster
+from folium.template import Template
+from requests.adapters import HTTPAdapter
+import shapely
 from shapely.geometry import Polygon, MultiPolygon
 
 # -------------------- Download tools --------------------
+# Session เดียวทั้งโมดูล: ใช้ keep-alive ซ้ำ connection เดิมแทนการเปิด TCP+TLS ใหม่ทุกครั้ง
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=16))
+
+_RE_DRIVE_FILE = re.compile(r"/file/d/([^/]+)/")
+_RE_DRIVE_ID = re.compile(r"[?&]id=([^&]+)")
+_RE_RAW_ID = re.compile(r"[A-Za-z0-9_-]{20,}")
+
 def extract_drive_id(url: str):
-    m = re.search(r"/file/d/([^/]+)/", url)
+    m = _RE_DRIVE_FILE.search(url)
     if m: return m.group(1)
-    m = re.search(r"[?&]id=([^&]+)", url)
+    m = _RE_DRIVE_ID.search(url)
     if m: return m.group(1)
     return ""
 
@@ -21,12 +35,21 @@ def download_any(url: str, suffix=".dat"):
         fid = extract_drive_id(url)
         gdown.download(id=fid, output=tmp.name, quiet=True)
     else:
-        r = requests.get(url, timeout=60)
-        r.raise_for_status()
-        with open(tmp.name, "wb") as f:
-            f.write(r.content)
+        # stream ลงดิสก์ทีละ 64 KiB แทนการโหลดทั้งไฟล์เข้า memory
+        with _SESSION.get(url, timeout=60, stream=True) as r:
+            r.raise_for_status()
+            with open(tmp.name, "wb") as f:
+                for chunk in r.iter_content(chunk_size=1 << 16):
+                    f.write(chunk)
     return tmp.name
 
+# -------------------- Read tools --------------------
+# ใช้ Arrow fast-path ของ pyogrio เมื่อมี pyarrow ติดตั้งอยู่
+_USE_ARROW = importlib.util.find_spec("pyarrow") is not None
+
+def read_any(path: str):
+    return pyogrio.read_dataframe(path, layer=0, use_arrow=_USE_ARROW)
+
 # -------------------- CRS tools --------------------
 def ensure_wgs84(gdf):
     if gdf.crs is None:
@@ -34,16 +57,73 @@ def ensure_wgs84(gdf):
     else:
         return gdf.to_crs(epsg=4326)
 
+# -------------------- Spatial filter --------------------
+def point_mask(geoms):
+    """True เฉพาะแถวที่เป็น Point และไม่ว่าง"""
+    return (shapely.get_type_id(geoms) == 0) & ~shapely.is_empty(geoms)
+
+def _in_bounds(poly, xs, ys, keep):
+    """index ของจุดที่อยู่ใน bbox ของ poly (เฉพาะที่ keep เป็น True)"""
+    minx, miny, maxx, maxy = poly.bounds
+    return np.flatnonzero(keep & (xs >= minx) & (xs <= maxx) & (ys >= miny) & (ys <= maxy))
+
+def points_within(pts, polygons):
+    """คืนเฉพาะจุดที่อยู่ใน union ของโพลิกอน (เหมือน pts.within(unary_union) แต่ไม่ต้อง union ทั้งชุด)
+    ตัดด้วย bbox ด้วย NumPy ก่อนเรียก GEOS ทั้งระดับรวมและระดับโพลิกอน"""
+    # get_x/get_y ใช้ได้เฉพาะ Point ที่ไม่ว่าง (POINT EMPTY จะ raise)
+    rows = np.flatnonzero(point_mask(pts.geometry.values))
+    geoms = pts.geometry.values[rows]
+    xs, ys = shapely.get_x(geoms), shapely.get_y(geoms)
+    minx, miny, maxx, maxy = polygons.total_bounds
+    bb = (xs >= minx) & (xs <= maxx) & (ys >= miny) & (ys <= maxy)
+    cand = rows[bb]
+    cx, cy = xs[bb], ys[bb]
+    inside = np.zeros(len(cand), dtype=bool)
+    polys = [p for p in polygons.geometry.values if p is not None and not p.is_empty]
+    for poly in polys:
+        sub = _in_bounds(poly, cx, cy, ~inside)  # ยังไม่พบว่าอยู่ในโพลิกอนอื่น
+        if len(sub) == 0:
+            continue
+        shapely.prepare(poly)
+        inside[sub] = shapely.contains_xy(poly, cx[sub], cy[sub])
+
+    # จุดบนขอบที่โพลิกอนติดกันใช้ร่วม: contains ของแต่ละโพลิกอนเป็น False
+    # แต่อยู่ภายใน union -> ตรวจซ้ำเฉพาะจุดที่แตะขอบ กับ union ของโพลิกอนที่ถูกแตะ
+    on_edge = np.zeros(len(cand), dtype=bool)
+    touched = []
+    for poly in polys:
+        sub = _in_bounds(poly, cx, cy, ~inside)
+        if len(sub) == 0:
+            continue
+        hit = shapely.intersects_xy(poly.boundary, cx[sub], cy[sub])
+        if hit.any():
+            on_edge[sub[hit]] = True
+            touched.append(poly)
+    if len(touched) > 1:
+        edge = np.flatnonzero(on_edge)
+        inside[edge] = shapely.contains_xy(shapely.union_all(touched), cx[edge], cy[edge])
+
+    mask = np.zeros(len(pts), dtype=bool)
+    mask[cand[inside]] = True
+    return pts.iloc[mask]
+
+# -------------------- GeoJSON tools --------------------
+def geometries_to_geojson(geoms):
+    """แปลง array ของ geometry เป็น list ของ GeoJSON geometry dict ด้วย GEOS writer"""
+    return [json.loads(g) if g is not None else None for g in shapely.to_geojson(geoms)]
+
 # -------------------- ICON tools --------------------
+@functools.lru_cache(maxsize=None)
 def drive_to_direct(url_or_id: str, size_px: int = 48) -> str:
-    if re.fullmatch(r"[A-Za-z0-9_-]{20,}", url_or_id):
+    if _RE_RAW_ID.fullmatch(url_or_id):
         fid = url_or_id
     else:
         fid = extract_drive_id(url_or_id) or url_or_id
     return f"https://drive.google.com/thumbnail?id={fid}&sz=w{size_px}"
 
+@functools.lru_cache(maxsize=None)
 def url_to_data_uri(url: str) -> str:
-    r = requests.get(url, timeout=60)
+    r = _SESSION.get(url, timeout=60)
     r.raise_for_status()
     content = r.content
     mime = "image/png"
@@ -56,72 +136,174 @@ def url_to_data_uri(url: str) -> str:
 def normalize_text(s: str) -> str:
     return str(s).strip().casefold()
 
-def icon_for_feature(props, icon_rules):
-    field = icon_rules.get("field")
+def _compile_rules(icon_rules):
+    """normalize mapping ของ icon_rules ครั้งเดียว: (field, exact, prefixes, default)"""
     mapping = icon_rules.get("mapping", {})
+    exact = {normalize_text(k): v for k, v in mapping.items() if not k.endswith("*")}
+    prefixes = [(normalize_text(k[:-1]), v) for k, v in mapping.items() if k.endswith("*")]
     default = icon_rules.get("default", {"icon":"map-marker","prefix":"fa"})
+    return icon_rules.get("field"), exact, prefixes, default
+
+def icon_for_feature(props, icon_rules):
+    """icon_rules: dict ของ rules หรือผลจาก _compile_rules (ควรส่งแบบหลังเมื่อเรียกในลูป)"""
+    if isinstance(icon_rules, dict):
+        icon_rules = _compile_rules(icon_rules)
+    field, exact, prefixes, default = icon_rules
 
     if not field or field not in props:
         return default
 
     val = normalize_text(props.get(field, ""))
-    norm_exact = {normalize_text(k): v for k, v in mapping.items()}
 
-    if val in norm_exact:
-        return norm_exact[val]
+    if val in exact:
+        return exact[val]
 
-    for k_raw, rule in mapping.items():
-        if k_raw.endswith("*"):
-            if val.startswith(normalize_text(k_raw[:-1])):
-                return rule
+    for prefix, rule in prefixes:
+        if val.startswith(prefix):
+            return rule
 
     return default
 
 # -------------------- Popup & Marker --------------------
+_ROW_FMT = "<tr><th style='text-align:left;padding:2px 6px;'>{k}</th><td style='padding:2px 6px;'>{v}</td></tr>"
+
+def _stringify(v):
+    if isinstance(v, (dict, list)):
+        return json.dumps(v, ensure_ascii=False)
+    return v
+
 def all_fields_popup_html(props: dict) -> str:
-    rows = []
-    for k, v in props.items():
-        if k == "geometry": continue
-        if isinstance(v, (dict, list)):
-            v = json.dumps(v, ensure_ascii=False)
-        rows.append(f"<tr><th style='text-align:left;padding:2px 6px;'>{k}</th><td style='padding:2px 6px;'>{v}</td></tr>")
-    return "<table>" + "".join(rows) + "</table>"
-
-def add_points_markers(target_layer, selected_gdf, icon_rules, icon_size_default=(28,28), embed_icons=True):
-    for _, row in selected_gdf.iterrows():
-        geom = row.geometry
-        if geom is None or geom.is_empty or geom.geom_type != "Point":
-            continue
-        lat, lon = geom.y, geom.x
-        props = row.drop(labels=["geometry"]).to_dict()
-        rule = icon_for_feature(props, icon_rules)
-        popup_html = all_fields_popup_html(props)
-
-        if "icon_url" in rule:
-            icon_url = rule["icon_url"]
-            if "drive.google.com" in icon_url or re.fullmatch(r"[A-Za-z0-9_-]{20,}", icon_url):
-                sz = rule.get("icon_size", list(icon_size_default))
-                px = max(sz) if isinstance(sz, (list, tuple)) else max(icon_size_default)
-                direct = drive_to_direct(icon_url, size_px=px)
-            else:
-                direct = icon_url
-
-            if embed_icons:
-                try:
-                    icon_src = url_to_data_uri(direct)
-                except Exception:
-                    icon_src = direct
-            else:
-                icon_src = direct
-
-            icon = folium.features.CustomIcon(icon_src, icon_size=rule.get("icon_size", list(icon_size_default)))
-            folium.Marker([lat, lon], popup=folium.Popup(popup_html, max_width=400), icon=icon).add_to(target_layer)
-        else:
-            folium.Marker(
-                [lat, lon],
-                popup=folium.Popup(popup_html, max_width=400),
-                icon=folium.Icon(icon=rule.get("icon","map-marker"), prefix=rule.get("prefix","fa"))
-            ).add_to(target_layer)
+    return "<table>" + "".join(
+        _ROW_FMT.format(k=k, v=_stringify(v)) for k, v in props.items() if k != "geometry"
+    ) + "</table>"
+
+def icon_direct_url(rule, icon_size_default=(28,28)) -> str:
+    icon_url = rule["icon_url"]
+    if "drive.google.com" in icon_url or _RE_RAW_ID.fullmatch(icon_url):
+        sz = rule.get("icon_size", list(icon_size_default))
+        px = max(sz) if isinstance(sz, (list, tuple)) else max(icon_size_default)
+        return drive_to_direct(icon_url, size_px=px)
+    return icon_url
+
+def icon_src_for_rule(rule, icon_size_default=(28,28), embed_icons=False, icon_cache=None) -> str:
+    """icon_cache: ผลจาก prefetch_icons ถ้ามี URL อยู่แล้วจะไม่ดาวน์โหลดซ้ำ (รวมถึงที่เคยล้มเหลว)"""
+    direct = icon_direct_url(rule, icon_size_default)
+    if embed_icons:
+        if icon_cache is not None and direct in icon_cache:
+            return icon_cache[direct]
+        try:
+            return url_to_data_uri(direct)
+        except Exception:
+            return direct
+    return direct
+
+def prefetch_icons(rules, icon_size_default=(28,28), max_workers=8):
+    """ดาวน์โหลดไอคอนที่ไม่ซ้ำกันพร้อมกันหลายเธรด คืน {direct_url: data URI}
+    URL ที่ดาวน์โหลดไม่สำเร็จจะได้ค่าเป็น direct URL เอง (ไม่ลองซ้ำ)"""
+    urls = list({icon_direct_url(r, icon_size_default) for r in rules if "icon_url" in r})
+
+    def fetch(url):
+        try:
+            return url_to_data_uri(url)
+        except Exception:
+            return url
+
+    with ThreadPoolExecutor(max_workers=max_workers) as ex:
+        return dict(zip(urls, ex.map(fetch, urls)))
+
+def make_icon(rule, icon_src=None, icon_size_default=(28,28)):
+    if icon_src is not None:
+        return folium.features.CustomIcon(icon_src, icon_size=rule.get("icon_size", list(icon_size_default)))
+    return folium.Icon(icon=rule.get("icon","map-marker"), prefix=rule.get("prefix","fa"))
+
+def add_icon_preloads(m, urls):
+    """ให้เบราว์เซอร์เริ่มโหลดไอคอน (ไม่กี่ไฟล์) ขนานกันตั้งแต่ต้นหน้า"""
+    links = "".join(f'<link rel="preload" as="image" href="{html.escape(u)}">' for u in dict.fromkeys(urls))
+    if links:
+        m.get_root().header.add_child(folium.Element(links))
+
+def add_points_markers(target_layer, selected_gdf, icon_rules, icon_size_default=(28,28), embed_icons=False,
+                       icon_cache=None):
+    """เพิ่มหมุดลง target_layer ซึ่งเป็น layer ที่มี addLayer เช่น folium.FeatureGroup หรือ
+    MarkerCluster (แนะนำ: เพิ่มหมุดเป็นก้อนผ่าน addLayers ทำให้ chunkedLoading ทำงาน)
+    คืนรายการ URL ไอคอนที่ไม่ได้ฝังเป็น data URI (ใช้ทำ preload)"""
+    geoms = selected_gdf.geometry.values
+    pts_gdf = selected_gdf[point_mask(geoms)]
+    # เหลือแต่ Point แล้ว จึงใช้ .x/.y แบบ columnar ของ GeoPandas ได้
+    # 6 ตำแหน่งทศนิยม (~10 ซม.) เพียงพอสำหรับ Leaflet และทำให้ JSON สั้นลง
+    geom_x = np.round(pts_gdf.geometry.x.to_numpy(), 6)
+    geom_y = np.round(pts_gdf.geometry.y.to_numpy(), 6)
+    records = pts_gdf.drop(columns="geometry").to_dict(orient="records")
+    points = list(zip(geom_x, geom_y, records))
+    compiled = _compile_rules(icon_rules)
+    rules = [icon_for_feature(props, compiled) for _, _, props in points]
+
+    # หนึ่ง icon ต่อหนึ่ง rule: เขียน icon ลง HTML ครั้งเดียว หมุดอ้างด้วย index
+    unique_rules = {id(r): r for r in rules}
+    if embed_icons and icon_cache is None:
+        icon_cache = prefetch_icons(unique_rules.values(), icon_size_default)
+    srcs = {
+        k: icon_src_for_rule(r, icon_size_default, embed_icons, icon_cache)
+        for k, r in unique_rules.items() if "icon_url" in r
+    }
+    icons = [make_icon(r, srcs.get(k), icon_size_default) for k, r in unique_rules.items()]
+    icon_index = {k: i for i, k in enumerate(unique_rules)}
+    for icon in icons:
+        target_layer.add_child(icon)
+
+    payload = [
+        {"ll": [lat, lon], "p": all_fields_popup_html(props), "i": icon_index[id(rule)]}
+        for (lon, lat, props), rule in zip(points, rules)
+    ]
+    target_layer.add_child(PointsPayload(payload, icons))
+
+    return [src for src in srcs.values() if not src.startswith("data:")]
+
+class PointsPayload(folium.MacroElement):
+    """หมุดทั้งชั้นเป็น JSON ก้อนเดียว แล้วสร้าง L.marker ฝั่งเบราว์เซอร์ (แทน folium.Marker ทีละตัว)"""
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+        (function() {
+            var icons = {{ this.icons|tojavascript }};
+            var pts = {{ this.payload }};
+            var markers = pts.map(function(p) {
+                return L.marker(p.ll, {icon: icons[p.i]}).bindPopup(p.p, {maxWidth: 400});
+            });
+            var parent = {{ this._parent.get_name() }};
+            // MarkerCluster: addLayers ทีละก้อน (chunkedLoading), layer อื่น ๆ: addLayer ทีละหมุด
+            if (parent.addLayers) {
+                parent.addLayers(markers);
+            } else {
+                markers.forEach(function(mk) { parent.addLayer(mk); });
+            }
+        })();
+        {% endmacro %}
+    """)
+
+    def __init__(self, payload, icons):
+        super().__init__()
+        self._name = "PointsPayload"
+        self.icons = icons
+        # ไม่ใช้ |tojson ของ template เพราะจะ escape < > ' ใน popup HTML ทุกตัวเป็น \u00XX (HTML ใหญ่ขึ้น ~60%)
+        # escape เฉพาะลำดับที่ปิด/รบกวนแท็ก <script> ได้
+        self.payload = (
+            json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
+            .replace("</", "<\\/")
+            .replace("<!--", "<\\!--")
+        )
+
+# -------------------- Save tools --------------------
+def save_map(m, out_html, compress=False):
+    """compress=True เขียนเป็น .html.gz (สำหรับ host ที่เสิร์ฟ gzip ได้) และคืน path ของไฟล์นั้น"""
+    html_text = m.get_root().render()
+    if compress:
+        out_html += ".gz"
+        with gzip.open(out_html, "wt", encoding="utf-8", compresslevel=6) as f:
+            f.write(html_text)
+    else:
+        with open(out_html, "w", encoding="utf-8") as f:
+            f.write(html_text)
+    return out_html
 
 # -------------------- ICON RULES --------------------
 DEFAULT_ICON_RULES = {
@@ -143,22 +325,30 @@ DEFAULT_ICON_RULES = {
 }
 
 # -------------------- Main Map Generator --------------------
-def generate_webmap(kml_url, points_url, site_name, ns_id, icon_rules=None):
-    """สร้าง Webmap พื้นหลังดาวเทียมเท่านั้น + LayerControl สำหรับข้อมูล"""
-    kml_path = download_any(kml_url, ".kml")
-    pts_path = download_any(points_url, ".geojson")
+def generate_webmap(kml_url, points_url, site_name, ns_id, icon_rules=None, embed_icons=False, compress=False):
+    """สร้าง Webmap พื้นหลังดาวเทียมเท่านั้น + LayerControl สำหรับข้อมูล
+    embed_icons=True ฝังไอคอนเป็น base64 ลงใน HTML (สำหรับเปิดแบบ offline)
+    compress=True บันทึกเป็น .html.gz แทน .html"""
+    icon_rules = icon_rules or DEFAULT_ICON_RULES
 
-    # โหลดข้อมูล
-    kml = gpd.read_file(kml_path, driver="KML")
-    pts = gpd.read_file(pts_path)
-    kml, pts = ensure_wgs84(kml), ensure_wgs84(pts)
+    # ดาวน์โหลด KML, จุด และไอคอนพร้อมกัน (socket IO ปล่อย GIL จึงใช้เธรดได้)
+    with ThreadPoolExecutor(max_workers=3) as ex:
+        f_kml = ex.submit(download_any, kml_url, ".kml")
+        f_pts = ex.submit(download_any, points_url, ".geojson")
+        f_icons = None
+        if embed_icons:
+            rules = [*icon_rules.get("mapping", {}).values(), icon_rules.get("default", {})]
+            f_icons = ex.submit(prefetch_icons, rules)
 
-    # รวมขอบเขต
-    geom = kml.geometry.unary_union
-    selected = pts[pts.within(geom)]
+        # โหลดข้อมูล
+        kml = ensure_wgs84(read_any(f_kml.result()))
+        pts = ensure_wgs84(read_any(f_pts.result()))
+
+        selected = points_within(pts, kml)
+        icon_cache = f_icons.result() if f_icons is not None else None
 
     # ขอบเขตซูม
-    minx, miny, maxx, maxy = geom.bounds
+    minx, miny, maxx, maxy = kml.total_bounds
 
     # === แผนที่หลัก (ไม่มี OSM) ===
     m = folium.Map(
@@ -177,9 +367,17 @@ def generate_webmap(kml_url, points_url, site_name, ns_id, icon_rules=None):
     )
     satellite_layer.add_to(m)
 
+    # === แปลงโพลิกอนเป็น GeoJSON ครั้งเดียว ใช้ร่วมกันทั้งชั้น Boundary และ Outline ===
+    # ส่ง dict ให้ folium.GeoJson แทน GeoDataFrame เพื่อข้าม __geo_interface__
+    kml_geojson = geometries_to_geojson(kml.geometry.values)
+    names = kml["Name"].tolist() if "Name" in kml.columns else [None] * len(kml)
+
     # === เพิ่มชั้น KML Boundary ===
     kml_layer = folium.GeoJson(
-        kml,
+        {"type": "FeatureCollection", "features": [
+            {"type": "Feature", "properties": {"Name": n} if "Name" in kml.columns else {}, "geometry": g}
+            for g, n in zip(kml_geojson, names) if g is not None
+        ]},
         name="KML Boundary",
         style_function=lambda x: {
             "fillColor": "#FF0000",
@@ -197,7 +395,11 @@ def generate_webmap(kml_url, points_url, site_name, ns_id, icon_rules=None):
 
     # === ชั้นเส้นขอบ Outline ===
     outline_layer = folium.GeoJson(
-        gpd.GeoSeries([geom], crs="EPSG:4326").__geo_interface__,
+        # เส้นขอบของแต่ละโพลิกอน (ไม่ union)
+        {"type": "FeatureCollection", "features": [
+            {"type": "Feature", "properties": {}, "geometry": g}
+            for g in kml_geojson if g is not None
+        ]},
         name="Boundary Outline",
         style_function=lambda x: {
             "fillColor": "#00000000",
@@ -208,10 +410,17 @@ def generate_webmap(kml_url, points_url, site_name, ns_id, icon_rules=None):
     outline_layer.add_to(m)
 
     # === ชั้นหมุดคู่แข่ง ===
-    icon_rules = icon_rules or DEFAULT_ICON_RULES
-    competitor_layer = folium.FeatureGroup(name="Competitor Points", show=True)
-    add_points_markers(competitor_layer, selected, icon_rules, embed_icons=True)
+    # chunkedLoading: ให้ Leaflet.markercluster เพิ่มหมุดเป็นช่วง ๆ ไม่ให้เบราว์เซอร์ค้าง
+    competitor_layer = MarkerCluster(
+        name="Competitor Points",
+        show=True,
+        options={"chunkedLoading": True, "chunkInterval": 100, "chunkDelay": 20}
+    )
+    icon_urls = add_points_markers(
+        competitor_layer, selected, icon_rules, embed_icons=embed_icons, icon_cache=icon_cache
+    )
     competitor_layer.add_to(m)
+    add_icon_preloads(m, icon_urls)
 
     # === ปรับขอบเขตแผนที่ ===
     m.fit_bounds([[miny, minx], [maxy, maxx]])
@@ -221,6 +430,5 @@ def generate_webmap(kml_url, points_url, site_name, ns_id, icon_rules=None):
 
     # === บันทึกไฟล์ ===
     out_html = f"{ns_id}_{site_name}.html".replace(" ", "_")
-    m.save(out_html)
-    return out_html
+    return save_map(m, out_html, compress=compress)
 